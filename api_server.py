@@ -1,133 +1,260 @@
 import os
 import time
-import requests
-import ast
+import asyncio
+import functools
+import httpx
 import re
-import json
+import secrets
+import hashlib
+import orjson
+import uvicorn
 from fastapi import FastAPI, Request, Form
 from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
+from diskcache import Cache
 from src.data_processing import research_fetcher
+from src.data_processing.plan_parser import parse_treatment_plan
 # Corrected function name to match the provided file
-from src.agent.patient_educational_material import generate_educational_pdf
+from src.agent.patient_educational_material import (
+    generate_educational_pdf,
+    iter_pdf_chunks,
+    stream_explanation,
+    warm_explanation,
+)
+from src.prompt_template.prompt_template import (
+    CLINICAL_DISCLAIMER,
+    LLM_TEMPERATURE,
+    PATIENT_DISCLAIMER,
+    RAG_MAX_NEW_TOKENS,
+    RAG_PROMPT_TEMPLATE,
+)
 
 # --- Configuration ---
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = SCRIPT_DIR
 PATIENT_TEXT_PATH = os.path.join(ROOT_DIR, "Data", "processed", "patient_text")
 RESEARCH_PAPER_PATH = os.path.join(ROOT_DIR, "Data", "processed", "research")
-# New temporary directory for plan data
-TMP_DIR = os.path.join(ROOT_DIR, "tmp") 
+# Generated plans, keyed by an opaque id handed to the client. Backed by diskcache
+# rather than a dict so every gunicorn worker sees the same plans.
+PLAN_STORE_PATH = os.path.join(ROOT_DIR, "tmp", "plans")
+PLAN_TTL = 900
 RAG_PIPELINE_URL = "http://localhost:8001/v2/answer"
+RAG_INDEXED_URL = "http://localhost:8001/v2/indexed"
+# Upper bound on how long to wait for the RAG server to index freshly fetched research.
+INDEXING_TIMEOUT = 25
+INDEXING_POLL_INTERVAL = 0.25
+# Treatment plans keyed by a hash of the normalized RAG prompt. A hit skips the research
+# fetch, the indexing wait and the RAG call; shared by all workers like the plan store.
+RAG_CACHE_PATH = os.path.join(ROOT_DIR, "tmp", "rag_cache")
+RAG_CACHE_TTL = 3600
+RAG_CACHE_SIZE_LIMIT = 2**28
+# Template fragments grouped into each chunk of the streamed index page.
+TEMPLATE_STREAM_BUFFER = 64
+# Number of decoded patient files kept in memory per worker.
+PATIENT_TEXT_CACHE_SIZE = 256
+
+# Precompiled patterns used to sanitize conditions into a RAG prompt.
+_CSEP_RE = re.compile(r'[,;]')
+_NONALPHA_RE = re.compile(r'[^a-zA-Z\s]')
+_WS_RE = re.compile(r'\s+')
+_TRAILING_PUNCT_RE = re.compile(r'[\s.,;:!?]+$')
 
 # --- FastAPI App Initialization ---
+try:
+    # uvloop is not available on Windows; fall back to the default asyncio loop there.
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 app = FastAPI()
 os.makedirs(os.path.join(SCRIPT_DIR, "templates"), exist_ok=True)
-# Ensure the temporary directory exists
-os.makedirs(TMP_DIR, exist_ok=True)
 templates = Jinja2Templates(directory=os.path.join(SCRIPT_DIR, "templates"))
 
+@app.on_event("startup")
+async def startup():
+    """
+    Creates the per-worker state: one pooled HTTP client shared by every
+    request handler, the patient list cache, and a handle on the plan store.
+    """
+    app.state.patient_cache = {"mtime": None, "list": []}
+    # Background explanation warm-ups, referenced here so they are not garbage-collected mid-flight.
+    app.state.warmups = set()
+    app.state.plans = Cache(PLAN_STORE_PATH)
+    app.state.rag_cache = Cache(
+        RAG_CACHE_PATH,
+        size_limit=RAG_CACHE_SIZE_LIMIT,
+        eviction_policy="least-recently-used",
+    )
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=180,
+        limits=httpx.Limits(max_keepalive_connections=32),
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.http.aclose()
+    app.state.plans.close()
+    app.state.rag_cache.close()
+
 # --- Helper Functions ---
 def get_patient_list():
-    """Reads the processed patient text files to get a list of patient IDs."""
-    if not os.path.exists(PATIENT_TEXT_PATH):
+    """
+    Reads the processed patient text files to get a list of patient IDs.
+    The list is cached and only rebuilt when the directory's mtime changes.
+    """
+    try:
+        mtime = os.stat(PATIENT_TEXT_PATH).st_mtime_ns
+    except FileNotFoundError:
         return []
-    patients = [f.replace(".txt", "") for f in os.listdir(PATIENT_TEXT_PATH) if f.endswith(".txt")]
-    return sorted(patients)
+    cache = app.state.patient_cache
+    if mtime == cache["mtime"]:
+        return cache["list"]
 
-def parse_treatment_plan(plan_text: str):
+    with os.scandir(PATIENT_TEXT_PATH) as entries:
+        patients = sorted(entry.name[:-4] for entry in entries if entry.name.endswith(".txt"))
+    cache["mtime"] = mtime
+    cache["list"] = patients
+    return patients
+
+@functools.lru_cache(maxsize=PATIENT_TEXT_CACHE_SIZE)
+def _read_patient_text(path: str, mtime_ns: int) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def read_patient_text(patient_id: str) -> str:
     """
-    Parses a string that is either markdown-like or a string representation
-    of a Python list into a structured list of dictionaries.
+    Returns a patient's text. Recurring patients are served from memory;
+    the file is only re-read when its mtime changes.
     """
-    if not isinstance(plan_text, str) or "No plan was generated" in plan_text or "Failed to generate" in plan_text:
-        return []
+    path = os.path.join(PATIENT_TEXT_PATH, f"{patient_id}.txt")
+    return _read_patient_text(path, os.stat(path).st_mtime_ns)
 
-    try:
-        parsed_data = ast.literal_eval(plan_text)
-        if isinstance(parsed_data, list) and all(isinstance(item, dict) for item in parsed_data):
-            print("[API Server] Successfully parsed string response with ast.literal_eval.")
-            return parsed_data
-    except (ValueError, SyntaxError):
-        print("[API Server] ast.literal_eval failed, falling back to markdown parser.")
-
-    print("[API Server] Using markdown parser.")
-    sections = []
-    parts = plan_text.split('**')
-    i = 1
-    while i < len(parts) - 1:
-        title = parts[i].strip().replace(':', '')
-        if "Preliminary Treatment Plan" in title or not title:
-            i += 2
-            continue
-        content_block = parts[i+1]
-        details = [detail.strip() for detail in content_block.strip().split('*') if detail.strip()]
-        if title and details:
-            sections.append({"condition": title, "details": details})
-        i += 2
-    return sections
+def render_index(context: dict) -> StreamingResponse:
+    """Streams the rendered index page to the client as Jinja produces it."""
+    stream = templates.get_template("index.html").stream(context)
+    # Unbuffered, every template fragment would be its own threadpool hop and ASGI send.
+    stream.enable_buffering(TEMPLATE_STREAM_BUFFER)
+    return StreamingResponse(stream, media_type="text/html")
+
+async def wait_for_indexing(file_paths: list, timeout: float = INDEXING_TIMEOUT) -> bool:
+    """
+    Polls the RAG server until every file in `file_paths` is reported as indexed.
+    Returns False if the timeout elapses first, so the caller can proceed regardless.
+    """
+    pending = set(file_paths)
+    if not pending:
+        return True
+
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        try:
+            response = await app.state.http.get(
+                RAG_INDEXED_URL,
+                params={"filepath_globpattern": f"{RESEARCH_PAPER_PATH}/*.txt"},
+                timeout=5,
+            )
+            response.raise_for_status()
+            if pending.issubset(orjson.loads(response.content)):
+                print(f"[API Server] New files indexed after {time.monotonic() - t0:.2f}s.")
+                return True
+        except httpx.HTTPError as e:
+            print(f"[API Server] Indexing status check failed: {e}")
+        await asyncio.sleep(INDEXING_POLL_INTERVAL)
+
+    print(f"[API Server] Timed out after {timeout}s waiting for RAG server to index new files.")
+    return False
+
+def rag_cache_key(prompt: str) -> str:
+    """
+    Hashes the prompt after lowercasing, collapsing whitespace and stripping trailing
+    punctuation, together with the RAG template and sampling settings so editing
+    either invalidates old plans.
+    """
+    normalized = _TRAILING_PUNCT_RE.sub('', _WS_RE.sub(' ', prompt.lower()).strip())
+    key = f"{RAG_MAX_NEW_TOKENS}\0{LLM_TEMPERATURE}\0{RAG_PROMPT_TEMPLATE}\0{normalized}"
+    return hashlib.blake2b(key.encode("utf-8")).hexdigest()
 
 # --- API Endpoints ---
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     """Serves the main page with a list of patients."""
-    return templates.TemplateResponse("index.html", {"request": request, "patients": get_patient_list()})
+    patients = await run_in_threadpool(get_patient_list)
+    return render_index({"request": request, "patients": patients})
 
 @app.post("/generate-plan", response_class=HTMLResponse)
 async def generate_treatment_plan(request: Request, patient_id: str = Form(...)):
     """
     Handles form submission, fetches research, queries the RAG server,
-    parses the result, saves it to a temporary file, and cleans up research files.
+    parses the result, stores it under a fresh plan id, and cleans up research files.
     """
-    patient_file_path = os.path.join(PATIENT_TEXT_PATH, f"{patient_id}.txt")
-    with open(patient_file_path, "r", encoding="utf-8") as f:
-        patient_info_text = f.read()
+    patient_info_text = await run_in_threadpool(read_patient_text, patient_id)
 
     created_files = []
     treatment_plan_structured = []
+    plan_truncated = False
     error_message = None
-    plan_file_path = None # Initialize plan file path
+    plan_id = None
 
     try:
-        created_files = research_fetcher.fetch_and_save_papers(patient_info_text)
-        wait_time = 23
-        print(f"[API Server] Waiting for {wait_time} seconds for RAG server to index new files...")
-        time.sleep(wait_time)
-
         conditions_raw = research_fetcher.extract_conditions(patient_info_text)
-        conditions_list = conditions_raw if isinstance(conditions_raw, list) else re.split(r'[,;]', str(conditions_raw))
+        conditions_list = conditions_raw if isinstance(conditions_raw, list) else _CSEP_RE.split(str(conditions_raw))
         unique_conditions = sorted(list(set([cond.strip() for cond in conditions_list if cond.strip()])))
-        cleaned_conditions = [re.sub(r'[^a-zA-Z\s]', '', cond).strip() for cond in unique_conditions]
-        final_conditions = [re.sub(r'\s+', ' ', cond) for cond in cleaned_conditions if cond]
+        cleaned_conditions = [_NONALPHA_RE.sub('', cond).strip() for cond in unique_conditions]
+        final_conditions = [_WS_RE.sub(' ', cond) for cond in cleaned_conditions if cond]
         prompt = " ".join(final_conditions) if final_conditions else "No conditions listed"
-        
-        print(f"[API Server] Sending sanitized, keyword-only prompt to RAG pipeline: \"{prompt}\"")
-
-        response = requests.post(
-            RAG_PIPELINE_URL,
-            json={"prompt": prompt},
-            timeout=180
-        )
-        response.raise_for_status()
-        
-        rag_response = response.json().get("response")
-
-        if isinstance(rag_response, list):
-            print("[API Server] RAG response is a valid list.")
-            treatment_plan_structured = rag_response
-        elif isinstance(rag_response, str):
-            print("[API Server] RAG response is a string, attempting to parse.")
-            treatment_plan_structured = parse_treatment_plan(rag_response)
-            
-        # If a plan was successfully generated, save it to a temporary file.
+
+        cache_key = rag_cache_key(prompt)
+        cached_plan = app.state.rag_cache.get(cache_key)
+        if cached_plan is not None:
+            print(f"[API Server] RAG cache hit for prompt: \"{prompt}\"")
+            treatment_plan_structured = orjson.loads(cached_plan)
+        else:
+            # A per-request token keeps this request's research files apart from concurrent ones,
+            # so it only waits on, and later deletes, what it wrote itself.
+            created_files = await research_fetcher.fetch_and_save_papers_async(
+                patient_info_text, app.state.http, request_token=secrets.token_hex(4)
+            )
+            print(f"[API Server] Waiting for RAG server to index {len(created_files)} new file(s)...")
+            await wait_for_indexing(created_files)
+
+            print(f"[API Server] Sending sanitized, keyword-only prompt to RAG pipeline: \"{prompt}\"")
+
+            response = await app.state.http.post(
+                RAG_PIPELINE_URL,
+                content=orjson.dumps({"prompt": prompt}),
+                headers={"Content-Type": "application/json"},
+            )
+            response.raise_for_status()
+
+            rag_response = orjson.loads(response.content).get("response")
+
+            if isinstance(rag_response, list):
+                print("[API Server] RAG response is a valid list.")
+                treatment_plan_structured = rag_response
+            elif isinstance(rag_response, str):
+                print("[API Server] RAG response is a string, attempting to parse.")
+                treatment_plan_structured, plan_truncated = parse_treatment_plan(rag_response)
+
+            # Only complete plans are cached; failures and cut-off plans are retried on the next request.
+            if treatment_plan_structured and not plan_truncated:
+                app.state.rag_cache.set(cache_key, orjson.dumps(treatment_plan_structured), expire=RAG_CACHE_TTL)
+
+        # If a plan was successfully generated, keep it for the PDF download under an opaque id.
         if treatment_plan_structured:
-            plan_file_path = os.path.join(TMP_DIR, f"{patient_id}_{int(time.time())}_plan.json")
-            with open(plan_file_path, "w") as f:
-                json.dump(treatment_plan_structured, f)
-            print(f"[API Server] Treatment plan saved to temporary file: {plan_file_path}")
+            plan_id = secrets.token_urlsafe(16)
+            app.state.plans.set(plan_id, orjson.dumps(treatment_plan_structured), expire=PLAN_TTL)
+            print(f"[API Server] Treatment plan stored with id: {plan_id}")
 
+            # Start the patient explanation now; the preview and PDF endpoints then hit its cache.
+            warmup = asyncio.create_task(warm_explanation(treatment_plan_structured))
+            app.state.warmups.add(warmup)
+            warmup.add_done_callback(app.state.warmups.discard)
 
-    except requests.exceptions.RequestException as e:
+
+    except httpx.HTTPError as e:
         error_message = f"Could not connect to the RAG Pipeline Server. Is it running? Error: {e}"
         print(f"[API Server] ERROR: {error_message}")
     
@@ -138,58 +265,75 @@ async def generate_treatment_plan(request: Request, patient_id: str = Form(...))
     finally:
         if created_files:
             print(f"[API Server] Cleaning up {len(created_files)} temporary research file(s)...")
-            research_fetcher.cleanup_papers(created_files)
+            await run_in_threadpool(research_fetcher.cleanup_papers, created_files)
 
-    return templates.TemplateResponse("index.html", {
+    patients = await run_in_threadpool(get_patient_list)
+    return render_index({
         "request": request,
-        "patients": get_patient_list(),
+        "patients": patients,
         "selected_patient_id": patient_id,
         "patient_info": patient_info_text,
         "treatment_plan": treatment_plan_structured,
-        "plan_file_path": plan_file_path, # Pass the file path to the template
+        "plan_truncated": plan_truncated,
+        "plan_id": plan_id,
+        "disclaimer": CLINICAL_DISCLAIMER,
         "error": error_message,
     })
 
+@app.post("/stream-education-text", response_class=StreamingResponse)
+async def stream_education_text(request: Request, plan_id: str = Form(...)):
+    """
+    Streams the patient-friendly explanation of a stored plan as plain text while the
+    LLM writes it. The plan is left in place, so the PDF can still be downloaded and
+    reuses the now-cached explanation.
+    """
+    data = app.state.plans.get(plan_id)
+    if data is None:
+        print(f"[API Server] ERROR: Plan {plan_id} not found or expired.")
+        return HTMLResponse(content="<h1>Error: Plan not found or expired. Please generate the plan again.</h1>", status_code=404)
+
+    async def explanation():
+        async for delta in stream_explanation(orjson.loads(data)):
+            yield delta
+        yield "\n\n" + PATIENT_DISCLAIMER.replace("**", "")
+
+    return StreamingResponse(explanation(), media_type="text/plain; charset=utf-8")
+
 @app.post("/generate-education-material", response_class=StreamingResponse)
-async def generate_education_material_pdf(request: Request, plan_file_path: str = Form(...)):
+async def generate_education_material_pdf(request: Request, plan_id: str = Form(...)):
     """
-    Receives the path to a temporary file containing the treatment plan,
-    reads it, generates a PDF, and streams it back for download.
+    Receives the id of a stored treatment plan, generates a PDF from it,
+    and streams it back for download. Each plan id can be used once; a plan
+    whose PDF fails to build is kept so the download can be retried.
     """
     try:
-        # Check if the file path is within the allowed temporary directory to prevent path traversal attacks.
-        if not os.path.abspath(plan_file_path).startswith(os.path.abspath(TMP_DIR)):
-            raise ValueError("Invalid file path provided.")
-
-        print(f"[API Server] Reading treatment plan from: {plan_file_path}")
-        with open(plan_file_path, "r") as f:
-            plan_data = json.load(f)
+        data = app.state.plans.get(plan_id)
+        if data is None:
+            print(f"[API Server] ERROR: Plan {plan_id} not found or expired.")
+            return HTMLResponse(content="<h1>Error: Plan not found or expired. Please generate the plan again.</h1>", status_code=404)
 
+        plan_data = orjson.loads(data)
         if not isinstance(plan_data, list):
-             raise ValueError("Data in plan file is not a list.")
+             raise ValueError("Stored plan is not a list.")
+
+        # The PDF is fully built before the response starts, so layout errors still reach the handlers below.
+        pdf_file = await generate_educational_pdf(plan_data)
+        app.state.plans.delete(plan_id)
 
-        pdf_buffer = generate_educational_pdf(plan_data)
-        
         headers = {
             'Content-Disposition': 'attachment; filename="patient_education_material.pdf"'
         }
-        return StreamingResponse(pdf_buffer, media_type='application/pdf', headers=headers)
+        return StreamingResponse(iter_pdf_chunks(pdf_file), media_type='application/pdf', headers=headers)
 
-    except (ValueError, json.JSONDecodeError) as e:
+    except (ValueError, orjson.JSONDecodeError) as e:
         print(f"[API Server] ERROR generating PDF: {e}")
         return HTMLResponse(content=f"<h1>Error processing data for PDF generation: {e}</h1>", status_code=500)
-    except FileNotFoundError:
-        print(f"[API Server] ERROR: Plan file not found at {plan_file_path}")
-        return HTMLResponse(content=f"<h1>Error: Plan file not found. Please generate the plan again.</h1>", status_code=404)
     except Exception as e:
         print(f"[API Server] UNEXPECTED ERROR during PDF generation: {e}")
         return HTMLResponse(content=f"<h1>An unexpected error occurred during PDF generation: {e}</h1>", status_code=500)
-    finally:
-        # Clean up the temporary plan file after use.
-        if plan_file_path and os.path.exists(plan_file_path):
-            try:
-                os.remove(plan_file_path)
-                print(f"[API Server] Cleaned up temporary plan file: {plan_file_path}")
-            except Exception as e:
-                 print(f"[API Server] ERROR cleaning up plan file {plan_file_path}: {e}")
 
+if __name__ == "__main__":
+    # Development entry point. uvicorn picks uvloop and httptools automatically when installed.
+    # In production, run one worker per core instead:
+    #   gunicorn api_server:app -k uvicorn.workers.UvicornWorker -w $(nproc) --worker-connections 1024 --keep-alive 30
+    uvicorn.run("api_server:app", host="0.0.0.0", port=8000)
@@ -1,10 +1,12 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import torch
 from dotenv import load_dotenv
 import pathway as pw
 from pathway.xpacks.llm import embedders, llms, parsers, splitters
 from pathway.stdlib.indexing.bm25 import TantivyBM25Factory
-from pathway.stdlib.indexing import BruteForceKnnFactory, HybridIndexFactory
+from pathway.stdlib.indexing import HybridIndexFactory, UsearchKnnFactory
 from pathway.xpacks.llm.document_store import DocumentStore
 from pathway.xpacks.llm.question_answering import BaseRAGQuestionAnswerer
 from pathway.xpacks.llm.servers import QASummaryRestServer
@@ -45,7 +47,16 @@ os.environ.setdefault("GOOGLE_API_KEY", GOOGLE_API_KEY or "")
 # Upgraded to a powerful 70B parameter model.
 # NOTE: This model requires a Hugging Face Pro subscription and a corresponding Pro API key.
 LLM_MODEL = "huggingface/meta-llama/Meta-Llama-3-70B-Instruct"
-EMBEDDER_DEVICE = "cpu" # Change to "cuda" if you have a GPU
+EMBEDDER_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# Larger batches amortise per-call overhead; a GPU can take far more rows at once.
+EMBEDDER_BATCH_SIZE = 64 if EMBEDDER_DEVICE == "cuda" else 32
+# Initial capacity of the HNSW vector index; usearch grows it as needed.
+USEARCH_RESERVED_SPACE = 100_000
+# Chunk sizes in tiktoken tokens. Fewer, larger chunks mean fewer embedder calls, but
+# all-MiniLM-L6-v2 truncates at 256 word pieces, which usually outnumber tiktoken
+# tokens, so the upper bound keeps some headroom below that window.
+SPLITTER_MIN_TOKENS = 128
+SPLITTER_MAX_TOKENS = 224
 
 
 # =========================
@@ -68,30 +79,39 @@ def ingest_synthea_csv(csv_file: str, output_folder: str):
     # Ensure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
 
-    for _, row in df.iterrows():
-        patient_id = row["id"]
-        filename = os.path.join(output_folder, f"{patient_id}.txt")
-
-        # Skip if the file already exists to avoid redundant processing
-        if os.path.exists(filename):
-            continue
-
-        # Create a concise, readable description for each patient
-        patient_text = (
-            f"Patient ID: {row['id']}\n"
-            f"Name: {row['name']}\n"
-            f"Gender: {row['gender']}\n"
-            f"Birth Date: {row['birthDate']}\n"
-            f"Conditions: {row.get('conditions', 'N/A')}\n"
-            f"Medications: {row.get('medications', 'N/A')}\n"
-        )
+    # Skip patients whose files already exist, using a single directory scan
+    # instead of one os.path.exists call per row.
+    existing = {f[:-4] for f in os.listdir(output_folder) if f.endswith(".txt")}
+    # Keep the first row per ID, matching the old per-row exists check.
+    df = df.drop_duplicates("id")
+    df = df[~df["id"].astype(str).isin(existing)]
+
+    def column(name):
+        return df[name].astype(str) if name in df.columns else "N/A"
+
+    # Build every patient's description in one vectorized pass.
+    patient_texts = (
+        "Patient ID: " + column("id") + "\n"
+        + "Name: " + column("name") + "\n"
+        + "Gender: " + column("gender") + "\n"
+        + "Birth Date: " + column("birthDate") + "\n"
+        + "Conditions: " + column("conditions") + "\n"
+        + "Medications: " + column("medications") + "\n"
+    )
 
+    def write_patient_file(item):
+        patient_id, patient_text = item
+        filename = os.path.join(output_folder, f"{patient_id}.txt")
         try:
             with open(filename, "w", encoding="utf-8") as f:
                 f.write(patient_text)
         except IOError as e:
             print(f"Could not write file for patient {patient_id}. Error: {e}")
 
+    # Writes are I/O-bound, so fan them out across a thread pool.
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        list(executor.map(write_patient_file, zip(df["id"].values, patient_texts.values)))
+
     print(f"Ingestion check completed. Patient files are located in: {output_folder}")
 
 
@@ -121,22 +141,28 @@ def run_pipeline():
     parser = parsers.UnstructuredParser()
 
     # 2. Splitter: To break down large documents into smaller, manageable chunks.
-    text_splitter = splitters.TokenCountSplitter(min_tokens=50, max_tokens=200)
+    text_splitter = splitters.TokenCountSplitter(min_tokens=SPLITTER_MIN_TOKENS, max_tokens=SPLITTER_MAX_TOKENS)
 
     # 3. Embedder: To convert text chunks into numerical vectors for semantic search.
     # Using a local SentenceTransformer model.
     embedder = embedders.SentenceTransformerEmbedder(
         model=EMBEDDING_MODEL_PATH,
         device=EMBEDDER_DEVICE,
-        batch_size=1
+        batch_size=EMBEDDER_BATCH_SIZE
     )
 
     # 4. Retriever: A hybrid retriever combining two search methods:
     #    - TantivyBM25Factory: A sparse retriever (keyword-based). Good for specific terms.
-    #    - BruteForceKnnFactory: A dense retriever (vector-based). Good for semantic similarity.
+    #    - UsearchKnnFactory: A dense retriever (vector-based, HNSW). Good for semantic similarity,
+    #      and scales sub-linearly with the corpus unlike a brute-force scan.
     index = HybridIndexFactory([
         TantivyBM25Factory(),
-        BruteForceKnnFactory(embedder=embedder),
+        UsearchKnnFactory(
+            embedder=embedder,
+            reserved_space=USEARCH_RESERVED_SPACE,
+            connectivity=16,
+            expansion_add=128,
+        ),
     ])
 
     # 5. Document Store: This component brings everything together.
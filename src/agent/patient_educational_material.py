@@ -1,62 +1,86 @@
 import os
 import re
-from io import BytesIO
+import asyncio
+import hashlib
+import orjson
+from diskcache import Cache
+from tempfile import SpooledTemporaryFile
+from typing import AsyncIterator
 from dotenv import load_dotenv
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
 from pathway.xpacks.llm import llms
+from starlette.concurrency import run_in_threadpool
 import litellm
-from src.prompt_template.prompt_template import PATIENT_EDUCATION_PROMPT_TEMPLATE
+from src.prompt_template.prompt_template import (
+    LLM_TEMPERATURE,
+    PATIENT_DISCLAIMER,
+    PATIENT_EDUCATION_PROMPT_TEMPLATE,
+    PATIENT_BASE_NEW_TOKENS,
+    PATIENT_NEW_TOKENS_PER_CONDITION,
+    patient_max_new_tokens,
+    render_patient_education,
+)
 
 # --- Configuration ---
 load_dotenv()
 HF_API_TOKEN = os.getenv("HF_API_TOKEN")
 LLM_MODEL = "huggingface/meta-llama/Meta-Llama-3-70B-Instruct"
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def generate_educational_pdf(treatment_plan: list) -> BytesIO:
-    """
-    Generates a patient educational PDF by explaining the treatment plan in simple terms using an LLM.
+# LLM explanations keyed by a hash of the canonical treatment plan, so repeat
+# requests for the same plan skip the 70B model entirely.
+EXPLANATION_CACHE = Cache(os.path.join(ROOT_DIR, "tmp", "llm_cache"), size_limit=2**30)
 
-    Args:
-        treatment_plan: A list of dictionaries, where each dictionary represents a medical condition and its details.
+# PDFs up to PDF_SPOOL_MAX_SIZE stay in memory; larger ones spill to a temporary file.
+PDF_SPOOL_MAX_SIZE = 256 * 1024
+PDF_CHUNK_SIZE = 64 * 1024
 
-    Returns:
-        An in-memory bytes buffer containing the generated PDF file.
-    """
-    print("[PDF Generator] Starting patient educational material generation...")
-    
-    # 1. Format the treatment plan data for the LLM prompt.
-    plan_str = ""
-    for item in treatment_plan:
-        condition = item.get('condition', 'N/A')
-        details_list = item.get('details', [])
-        details = "\n  - ".join(details_list) if isinstance(details_list, list) else "No details."
-        plan_str += f"- Condition: {condition}\n  - Details: {details}\n"
-
-    # 2. Configure the LLM using the pathway object, but execute with a direct call for a clean response.
-    llm = llms.LiteLLMChat(model=LLM_MODEL, api_key=HF_API_TOKEN)
-    prompt = PATIENT_EDUCATION_PROMPT_TEMPLATE.format(treatment_plan=plan_str)
-    
-    print("[PDF Generator] Sending request to LLM for explanation...")
-    explanation_text = ""
+# Explanations generated ahead of the download, right after a plan is produced.
+# Capped per worker so a burst of plans does not flood the LLM endpoint.
+MAX_CONCURRENT_WARMUPS = 4
+_WARMUP_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_WARMUPS)
+
+EXPLANATION_ERROR_TEXT = "There was an error generating the detailed explanation for your treatment plan. Please consult your doctor directly."
+EXPLANATION_TRUNCATED_TEXT = "This explanation was cut short. Please ask your doctor about any part of your plan not covered here."
+
+# Precompiled patterns used to turn the LLM's markdown into reportlab markup.
+_PARAGRAPH_BREAK_RE = re.compile(r'\n\s*\n')
+_BOLD_RE = re.compile(r'\*\*(.*?)\*\*')
+
+# The pathway LLM object carries the model configuration; the router executes the calls
+# and is created once so repeated PDF requests reuse its pooled HTTP connections.
+llm = llms.LiteLLMChat(model=LLM_MODEL, api_key=HF_API_TOKEN)
+router = litellm.Router(model_list=[{
+    "model_name": LLM_MODEL,
+    "litellm_params": {"model": llm.model, "api_key": HF_API_TOKEN},
+}])
+
+def _plan_cache_key(treatment_plan: list) -> str:
+    """Hashes the canonical plan JSON together with the model, settings and prompt that explain it."""
+    payload = {
+        "model": LLM_MODEL,
+        "max_tokens": [PATIENT_BASE_NEW_TOKENS, PATIENT_NEW_TOKENS_PER_CONDITION],
+        "temperature": LLM_TEMPERATURE,
+        "template": PATIENT_EDUCATION_PROMPT_TEMPLATE,
+        "plan": treatment_plan,
+    }
+    return hashlib.blake2b(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def _build_pdf(explanation_text: str) -> SpooledTemporaryFile:
+    """Lays out the LLM explanation as a PDF and returns the spooled file, rewound."""
+    buffer = SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_SIZE)
     try:
-        # Use litellm.completion for a direct call, using config from the pathway object.
-        # This respects the "do not remove pathway" constraint while getting a clean string.
-        messages = [{"role": "user", "content": prompt}]
-        response = litellm.completion(
-            model=llm.model,
-            messages=messages,
-            api_key=HF_API_TOKEN
-        )
-        explanation_text = response.choices[0].message.content
-        print("[PDF Generator] Received explanation from LLM.")
-    except Exception as e:
-        print(f"[PDF Generator] ERROR: Failed to get explanation from LLM: {e}")
-        explanation_text = "There was an error generating the detailed explanation for your treatment plan. Please consult your doctor directly."
+        _layout_pdf(buffer, explanation_text)
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
 
-    # 3. Use reportlab to create a well-formatted PDF document.
-    buffer = BytesIO()
+def _layout_pdf(buffer: SpooledTemporaryFile, explanation_text: str) -> None:
+    """Writes the title and one paragraph per block of the explanation into `buffer`."""
     doc = SimpleDocTemplate(buffer, pagesize=letter)
     styles = getSampleStyleSheet()
     story = []
@@ -67,14 +91,14 @@ def generate_educational_pdf(treatment_plan: list) -> BytesIO:
 
     # **DEFINITIVE FIX**: Process the LLM text to create well-formatted paragraphs.
     # Split the response into blocks based on empty lines (the standard for paragraphs).
-    blocks = re.split(r'\n\s*\n', explanation_text)
+    blocks = _PARAGRAPH_BREAK_RE.split(explanation_text)
     for block in blocks:
         block = block.strip()
         if not block:
             continue
         
         # Convert markdown-style bold (**) to reportlab's <b> tag.
-        block = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', block)
+        block = _BOLD_RE.sub(r'<b>\1</b>', block)
         
         # Convert single newlines within a block into <br/> tags for line breaks.
         block = block.replace('\n', '<br/>')
@@ -83,8 +107,154 @@ def generate_educational_pdf(treatment_plan: list) -> BytesIO:
         story.append(Spacer(1, 12)) # Add a small space after each paragraph
 
     doc.build(story)
-    
-    buffer.seek(0)
+
+def _render_plan(treatment_plan: list) -> str:
+    """Formats the treatment plan for the LLM prompt, one compact line per condition."""
+    lines = []
+    for item in treatment_plan:
+        condition = item.get('condition', 'N/A')
+        details_list = item.get('details', [])
+        details = "; ".join(details_list) if isinstance(details_list, list) else "No details."
+        lines.append(f"- {condition}: {details}")
+    return "\n".join(lines)
+
+class _Generation:
+    """
+    One in-flight LLM explanation. The producer task pushes deltas as they arrive and
+    any number of readers follow along, each from the first delta.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.done = False
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def push(self, delta: str) -> None:
+        self.parts.append(delta)
+        self._wake()
+
+    def finish(self) -> None:
+        self.done = True
+        self._wake()
+
+    def _wake(self) -> None:
+        # Release the current waiters and give later ones a fresh event.
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self) -> AsyncIterator[str]:
+        i = 0
+        while True:
+            while i < len(self.parts):
+                yield self.parts[i]
+                i += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+# Explanations currently being generated in this worker, keyed by `_plan_cache_key`, so a
+# download arriving during the warm-up follows the running call instead of starting another.
+_IN_FLIGHT: dict[str, _Generation] = {}
+
+async def _produce_explanation(cache_key: str, treatment_plan: list, generation: _Generation) -> None:
+    """Streams the explanation from the LLM into `generation` and caches it on success."""
+    print("[PDF Generator] Streaming explanation from LLM...")
+    messages = [{"role": "user", "content": render_patient_education(_render_plan(treatment_plan))}]
+    parts = []
+    finish_reason = None
+    try:
+        response = await router.acompletion(
+            model=LLM_MODEL,
+            messages=messages,
+            max_tokens=patient_max_new_tokens(len(treatment_plan)),
+            temperature=LLM_TEMPERATURE,
+            stream=True,
+        )
+        async for chunk in response:
+            choice = chunk.choices[0]
+            finish_reason = choice.finish_reason or finish_reason
+            if choice.delta.content:
+                parts.append(choice.delta.content)
+                generation.push(choice.delta.content)
+    except Exception as e:
+        print(f"[PDF Generator] ERROR: Failed to get explanation from LLM: {e}")
+        # Nothing reaches the cache, so the next request retries the LLM.
+        generation.push(("\n\n" if parts else "") + EXPLANATION_ERROR_TEXT)
+    else:
+        if finish_reason == "length":
+            # Cut off by the output cap: tell the reader, and leave the cache for a retry.
+            print(f"[PDF Generator] WARNING: Explanation hit the output cap for {len(treatment_plan)} condition(s); not caching it.")
+            generation.push("\n\n" + EXPLANATION_TRUNCATED_TEXT)
+            return
+
+        EXPLANATION_CACHE.set(cache_key, "".join(parts))
+        print("[PDF Generator] Received explanation from LLM.")
+    finally:
+        _IN_FLIGHT.pop(cache_key, None)
+        generation.finish()
+
+async def stream_explanation(treatment_plan: list) -> AsyncIterator[str]:
+    """
+    Yields the patient-friendly explanation of a treatment plan as the LLM produces it,
+    so callers can show the first words long before the full text is decoded.
+    Cached explanations are yielded in one piece; a completed stream is cached.
+    Concurrent callers for the same plan share a single LLM call.
+    """
+    cache_key = _plan_cache_key(treatment_plan)
+    explanation_text = EXPLANATION_CACHE.get(cache_key)
+    if explanation_text is not None:
+        print("[PDF Generator] Using cached explanation for this treatment plan.")
+        yield explanation_text
+        return
+
+    generation = _IN_FLIGHT.get(cache_key)
+    if generation is None:
+        generation = _IN_FLIGHT[cache_key] = _Generation()
+        # Run as a task so the call completes and is cached even if this reader disconnects.
+        generation.task = asyncio.create_task(_produce_explanation(cache_key, treatment_plan, generation))
+    else:
+        print("[PDF Generator] Joining the explanation already being generated for this plan.")
+
+    async for delta in generation.follow():
+        yield delta
+
+async def warm_explanation(treatment_plan: list) -> None:
+    """
+    Generates and caches the explanation for a freshly produced plan in the background,
+    so the second stage runs while the clinician reads the plan instead of after they
+    ask for the PDF.
+    """
+    async with _WARMUP_SEMAPHORE:
+        async for _ in stream_explanation(treatment_plan):
+            pass
+
+async def generate_educational_pdf(treatment_plan: list) -> SpooledTemporaryFile:
+    """
+    Generates a patient educational PDF by explaining the treatment plan in simple terms using an LLM.
+
+    Args:
+        treatment_plan: A list of dictionaries, where each dictionary represents a medical condition and its details.
+
+    Returns:
+        The finished PDF as a rewound spooled file. Layout errors are raised here,
+        before any response has started; stream the file with `iter_pdf_chunks`.
+    """
+    print("[PDF Generator] Starting patient educational material generation...")
+
+    # 1. Collect the explanation; the PDF layout needs the whole text.
+    explanation_text = "".join([delta async for delta in stream_explanation(treatment_plan)])
+
+    # 2. Use reportlab to create a well-formatted PDF document, off the event loop.
+    # The disclaimer is appended here rather than cached, so wording changes apply at once.
+    buffer = await run_in_threadpool(_build_pdf, explanation_text + "\n\n" + PATIENT_DISCLAIMER)
     print("[PDF Generator] PDF generation complete.")
     return buffer
 
+async def iter_pdf_chunks(buffer: SpooledTemporaryFile) -> AsyncIterator[bytes]:
+    """Yields a finished PDF in chunks of at most PDF_CHUNK_SIZE, closing the file afterwards."""
+    try:
+        while chunk := await run_in_threadpool(buffer.read, PDF_CHUNK_SIZE):
+            yield chunk
+    finally:
+        buffer.close()
@@ -9,17 +9,28 @@ ROOT_DIR = os.path.dirname(os.path.dirname(SCRIPT_DIR))
 # Add the project root to the Python path
 sys.path.append(ROOT_DIR)
 
+from collections import defaultdict
+
+import orjson
 import pandas as pd
+import torch
+import litellm
 from dotenv import load_dotenv
 import pathway as pw
 from pathway.xpacks.llm import embedders, llms, parsers, splitters
 from pathway.stdlib.indexing.bm25 import TantivyBM25Factory
-from pathway.stdlib.indexing import BruteForceKnnFactory, HybridIndexFactory
+from pathway.stdlib.indexing import HybridIndexFactory, UsearchKnnFactory
 from pathway.xpacks.llm.document_store import DocumentStore
 from pathway.xpacks.llm.question_answering import BaseRAGQuestionAnswerer
 from pathway.xpacks.llm.servers import QASummaryRestServer
 # This import will now work correctly
-from src.prompt_template.prompt_template import RAG_PROMPT_TEMPLATE
+from src.prompt_template.prompt_template import (
+    LLM_TEMPERATURE,
+    RAG_MAX_NEW_TOKENS,
+    RAG_STOP,
+    canonical_context,
+    render_rag,
+)
 
 # =========================
 #       CONFIGURATION
@@ -43,7 +54,130 @@ HF_API_TOKEN = os.getenv("HF_API_TOKEN")
 os.environ.setdefault("HF_API_TOKEN", HF_API_TOKEN or "")
 
 LLM_MODEL = "huggingface/meta-llama/Meta-Llama-3-70B-Instruct"
-EMBEDDER_DEVICE = "cpu"
+EMBEDDER_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# Larger batches amortise per-call overhead; a GPU can take far more rows at once.
+EMBEDDER_BATCH_SIZE = 64 if EMBEDDER_DEVICE == "cuda" else 32
+# Initial capacity of the HNSW vector index; usearch grows it as needed.
+USEARCH_RESERVED_SPACE = 100_000
+# Chunk sizes in tiktoken tokens. Fewer, larger chunks mean fewer embedder calls, but
+# all-MiniLM-L6-v2 truncates at 256 word pieces, which usually outnumber tiktoken
+# tokens, so the upper bound keeps some headroom below that window.
+SPLITTER_MIN_TOKENS = 128
+SPLITTER_MAX_TOKENS = 224
+
+# Maximum number of RAG prompts sent to the LLM in one batched call. Queries
+# arriving within the REST connector's 50ms commit window share a batch.
+BATCH_MAX = 8
+
+
+# =========================
+#       BATCHED LLM
+# =========================
+
+def _decode_messages(messages) -> list:
+    if isinstance(messages, pw.Json):
+        messages = messages.as_list()
+    return [m.as_dict() if isinstance(m, pw.Json) else m for m in messages]
+
+def _complete_batch(conversations: list, **call_kwargs) -> list[str | None]:
+    """
+    Sends every distinct conversation once in a single `litellm.batch_completion`
+    call and returns one answer (or None on failure) per input conversation.
+    """
+    # Map each distinct conversation to the positions that asked it, so duplicates pay prefill once.
+    unique = defaultdict(list)
+    for i, messages in enumerate(conversations):
+        unique[orjson.dumps(messages, option=orjson.OPT_SORT_KEYS)].append(i)
+
+    results = [None] * len(conversations)
+    responses = litellm.batch_completion(
+        messages=[conversations[same[0]] for same in unique.values()], **call_kwargs
+    )
+    for same, response in zip(unique.values(), responses):
+        if isinstance(response, Exception):
+            print(f"[Pipeline] Batched LLM call failed: {response}")
+            continue
+        content = response.choices[0].message.content
+        for i in same:
+            results[i] = content
+    print(f"[Pipeline] Answered {len(conversations)} prompt(s) with {len(unique)} unique request(s).")
+    return results
+
+def submit_batch(prompts: list[str], **litellm_kwargs) -> list[str | None]:
+    """
+    Sends already rendered prompts (e.g. from `render_rag_batch`) to the LLM in one
+    batched call, for bulk processing outside the REST server.
+    """
+    conversations = [[{"role": "user", "content": prompt}] for prompt in prompts]
+    return _complete_batch(conversations, **{
+        "model": LLM_MODEL,
+        "api_key": HF_API_TOKEN,
+        "max_tokens": RAG_MAX_NEW_TOKENS,
+        "temperature": LLM_TEMPERATURE,
+        "stop": RAG_STOP,
+        **litellm_kwargs,
+    })
+
+class BatchedLiteLLMChat(llms.LiteLLMChat):
+    """
+    LiteLLM chat that receives up to `max_batch_size` prompts per call and
+    submits them together with `litellm.batch_completion`, instead of one
+    completion request per row. Identical prompts within a batch are sent once
+    and their answer is shared.
+    """
+
+    def __init__(self, model: str, max_batch_size: int = BATCH_MAX, **litellm_kwargs):
+        # Pathway only batches synchronous UDFs, so skip LiteLLMChat's async executor.
+        llms.BaseChat.__init__(self, max_batch_size=max_batch_size)
+        self.kwargs.update(litellm_kwargs)
+        self.kwargs["model"] = model
+
+    def __wrapped__(self, messages_list: list, **kwargs) -> list[str | None]:
+        decoded = [_decode_messages(messages) for messages in messages_list]
+
+        # Each kwarg arrives as one value per row; rows sharing the same
+        # overrides (e.g. `model`) go out as a single batch.
+        rows = [
+            tuple((key, v.value if isinstance(v, pw.Json) else v) for key, v in zip(kwargs, values))
+            for values in zip(*kwargs.values())
+        ] if kwargs else [()] * len(decoded)
+        groups = defaultdict(list)
+        for i, row in enumerate(rows):
+            groups[row].append(i)
+
+        results = [None] * len(decoded)
+        for row, indices in groups.items():
+            call_kwargs = {**self.kwargs, **{key: v for key, v in row if v is not None}}
+            answers = _complete_batch([decoded[i] for i in indices], **call_kwargs)
+            for i, answer in zip(indices, answers):
+                results[i] = answer
+        return results
+
+
+# =========================
+#       QUERY HANDLERS
+# =========================
+
+def indexed_paths_query(document_store: DocumentStore):
+    """
+    Builds the handler for `/v2/indexed`, which returns the source paths
+    the document store has finished parsing and indexing.
+    """
+    @pw.udf
+    def _indexed_paths(metadatas: list[pw.Json]) -> list[str]:
+        return [
+            m["path"].as_str()
+            for m in metadatas
+            if m["_indexing_status"].as_str() == "INDEXED"
+        ]
+
+    def handler(queries: pw.Table) -> pw.Table:
+        queries = queries.with_columns(return_status=True)
+        return document_store.inputs_query(queries).select(
+            result=_indexed_paths(pw.this.result)
+        )
+
+    return handler
 
 
 # =========================
@@ -72,15 +206,20 @@ def run_pipeline():
     ]
 
     parser = parsers.UnstructuredParser()
-    text_splitter = splitters.TokenCountSplitter(min_tokens=50, max_tokens=200)
+    text_splitter = splitters.TokenCountSplitter(min_tokens=SPLITTER_MIN_TOKENS, max_tokens=SPLITTER_MAX_TOKENS)
     embedder = embedders.SentenceTransformerEmbedder(
         model=EMBEDDING_MODEL_PATH,
         device=EMBEDDER_DEVICE,
-        batch_size=1
+        batch_size=EMBEDDER_BATCH_SIZE
     )
     index = HybridIndexFactory([
         TantivyBM25Factory(),
-        BruteForceKnnFactory(embedder=embedder),
+        UsearchKnnFactory(
+            embedder=embedder,
+            reserved_space=USEARCH_RESERVED_SPACE,
+            connectivity=16,
+            expansion_add=128,
+        ),
     ])
     document_store = DocumentStore(
         docs=sources,
@@ -90,19 +229,30 @@ def run_pipeline():
     )
     print("Document store and index created successfully.")
 
-    llm = llms.LiteLLMChat(
+    llm = BatchedLiteLLMChat(
         model=LLM_MODEL,
-        api_key=HF_API_TOKEN
+        api_key=HF_API_TOKEN,
+        max_tokens=RAG_MAX_NEW_TOKENS,
+        temperature=LLM_TEMPERATURE,
+        stop=RAG_STOP,
     )
 
     qa_answerer = BaseRAGQuestionAnswerer(
         llm=llm,
         indexer=document_store,
-        prompt_template=RAG_PROMPT_TEMPLATE
+        prompt_template=render_rag,
+        context_processor=canonical_context,
     )
 
     server_port = 8001
     server = QASummaryRestServer("0.0.0.0", server_port, qa_answerer)
+    # Lets the API server poll for freshly fetched research instead of sleeping blindly.
+    server.serve(
+        "/v2/indexed",
+        DocumentStore.InputsQuerySchema,
+        indexed_paths_query(document_store),
+        methods=("GET", "POST"),
+    )
     print(f"Starting Q&A REST server on http://0.0.0.0:{server_port} ...")
     server.run(with_cache=True)
 
@@ -0,0 +1,77 @@
+import ast
+import json
+import re
+import orjson
+
+# Start of a JSON array of objects, and a decoder to read its items one at a time.
+_JSON_ARRAY_START_RE = re.compile(r'\[\s*(?=\{)')
+_JSON_DECODER = json.JSONDecoder()
+# A **title** followed by its content, up to the next ** or the end of the text.
+_SECTION_RE = re.compile(r'\*\*(.*?)\*\*(.*?)(?=\*\*|\Z)', re.DOTALL)
+
+def leading_plan_items(plan_text: str) -> list:
+    """
+    Returns the complete objects at the start of a JSON array, for output that the
+    token cap cut off mid-array. Stops at the first item that does not fully parse.
+    """
+    match = _JSON_ARRAY_START_RE.search(plan_text)
+    if not match:
+        return []
+
+    items = []
+    pos = match.end()
+    while True:
+        try:
+            item, pos = _JSON_DECODER.raw_decode(plan_text, pos)
+        except ValueError:
+            break
+        if not isinstance(item, dict):
+            break
+        items.append(item)
+        # Skip the separator before the next item.
+        while pos < len(plan_text) and plan_text[pos] in ', \t\r\n':
+            pos += 1
+    return items
+
+def parse_treatment_plan(plan_text: str) -> tuple[list, bool]:
+    """
+    Parses a string that is either JSON, a string representation of a Python
+    list, or markdown-like into a structured list of dictionaries.
+
+    Returns:
+        The plan, and whether it was recovered from a JSON array that was cut off,
+        in which case conditions after the last complete item are missing.
+    """
+    if not isinstance(plan_text, str) or "No plan was generated" in plan_text or "Failed to generate" in plan_text:
+        return [], False
+
+    # The model is asked for a bare JSON array but may still wrap it in a code fence or a
+    # sentence, so parse the outermost [...] span.
+    start, end = plan_text.find('['), plan_text.rfind(']')
+    array_text = plan_text[start:end + 1] if 0 <= start < end else plan_text
+
+    # orjson rejects non-JSON input almost immediately, so try it before the much slower AST parse.
+    for parse in (orjson.loads, ast.literal_eval):
+        try:
+            parsed_data = parse(array_text)
+        except (ValueError, SyntaxError):
+            continue
+        if isinstance(parsed_data, list) and all(isinstance(item, dict) for item in parsed_data):
+            print(f"[Plan Parser] Successfully parsed string response with {parse.__module__}.{parse.__name__}.")
+            return parsed_data, False
+
+    recovered = leading_plan_items(plan_text)
+    if recovered:
+        print(f"[Plan Parser] Recovered {len(recovered)} complete item(s) from a truncated JSON plan.")
+        return recovered, True
+
+    print("[Plan Parser] Using markdown parser.")
+    sections = []
+    for match in _SECTION_RE.finditer(plan_text):
+        title = match.group(1).strip().replace(':', '')
+        if not title or "Preliminary Treatment Plan" in title:
+            continue
+        details = [detail.strip() for detail in match.group(2).split('*') if detail.strip()]
+        if details:
+            sections.append({"condition": title, "details": details})
+    return sections, False
@@ -1,12 +1,44 @@
 import os
 import re
+import asyncio
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from diskcache import Cache
 
 # --- Configuration ---
 # Navigate three levels up from the current script's location (src/data_processing/research_fetcher.py) to reach the project root.
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 RESEARCH_PAPER_PATH = os.path.join(ROOT_DIR, "Data", "processed", "research")
+SEARCH_URL = "https://api.semanticscholar.org/graph/v1/paper/search"
+# Number of Semantic Scholar searches in flight at once per worker, across all requests.
+MAX_CONCURRENT_SEARCHES = 4
+
+# Search results (title + abstract only) are cached on disk per query string,
+# so conditions shared across patients do not hit the API again for a day.
+SEARCH_CACHE = Cache(os.path.join(ROOT_DIR, "tmp", "ss_cache"))
+SEARCH_CACHE_TTL = 86400
+
+# Precompiled patterns used on every request.
+_COND_RE = re.compile(r"Conditions:(.*?)(?:\n\n[A-Z][a-z]+:|$)", re.DOTALL)
+_SPLIT_RE = re.compile(r'[\n;]')
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\s-]')
+
+# One pooled session for the synchronous path, so retries and successive conditions
+# reuse the TCP/TLS connection to Semantic Scholar instead of reconnecting each time.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+
+# Shared by every `fetch_and_save_papers_async` call in this worker, so overlapping
+# requests queue behind the same cap instead of each adding their own searches.
+_SEARCH_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_SEARCHES)
+
+# Paper files are written off the request path so disk I/O overlaps with the next searches.
+_WRITE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="paper-writer")
 
 # --- Core Functions ---
 
@@ -17,12 +49,12 @@ def extract_conditions(patient_info: str) -> list:
     """
     conditions = []
     # Use regex to find the block of text between "Conditions:" and the next major heading
-    match = re.search(r"Conditions:(.*?)(?:\n\n[A-Z][a-z]+:|$)", patient_info, re.DOTALL)
+    match = _COND_RE.search(patient_info)
     if match:
         conditions_text = match.group(1)
         
         # Split the block into lines and process each one.
-        potential_conditions = re.split(r'[\n;]', conditions_text)
+        potential_conditions = _SPLIT_RE.split(conditions_text)
         
         for item in potential_conditions:
             # Only keep items that are explicitly marked as disorders.
@@ -35,15 +67,62 @@ def extract_conditions(patient_info: str) -> list:
     print(f"[Research Fetcher] Found conditions: {conditions}")
     return conditions
 
-def _perform_search(query: str, condition: str) -> list:
-    """Helper function to perform a single search with retries."""
-    search_url = "https://api.semanticscholar.org/graph/v1/paper/search"
+def _format_paper(paper: dict, request_token: str = "") -> tuple:
+    """
+    Returns the (filepath, file contents) pair used to save a single paper. The request
+    token is appended to the filename so concurrent requests never share, or delete,
+    each other's files.
+    """
+    title = paper.get("title", "Untitled Paper")
+    abstract = paper.get("abstract", "No abstract available.")
+
+    safe_filename = _UNSAFE_FILENAME_RE.sub('', title).strip().replace(' ', '_')[:60]
+    if request_token:
+        safe_filename = f"{safe_filename}_{request_token}"
+    filepath = os.path.join(RESEARCH_PAPER_PATH, f"{safe_filename}.txt")
+    return filepath, f"Title: {title}\n\nAbstract: {abstract}"
+
+def _write_paper(filepath: str, content: str) -> str:
+    Path(filepath).write_bytes(content.encode("utf-8"))
+    return filepath
+
+def _paper_writes(papers: list, request_token: str) -> dict:
+    # Papers whose titles sanitize to the same filename collapse into one write (last one wins).
+    return dict(_format_paper(paper, request_token) for paper in papers)
+
+def _save_papers(papers: list, request_token: str = "") -> list:
+    """Writes the papers to the research folder in parallel and returns their paths."""
+    writes = _paper_writes(papers, request_token)
+    return list(_WRITE_POOL.map(_write_paper, writes.keys(), writes.values()))
+
+async def _save_papers_async(papers: list, request_token: str = "") -> list:
+    """Async counterpart of `_save_papers`."""
+    loop = asyncio.get_running_loop()
+    return list(await asyncio.gather(*[
+        loop.run_in_executor(_WRITE_POOL, _write_paper, filepath, content)
+        for filepath, content in _paper_writes(papers, request_token).items()
+    ]))
+
+def _extract_papers(results: dict) -> list:
+    """Keeps only the title and abstract of papers that have an abstract."""
+    if not results or not results.get("data"):
+        return []
+    return [
+        {"title": paper.get("title", "Untitled Paper"), "abstract": paper["abstract"]}
+        for paper in results["data"]
+        if paper and paper.get("abstract")
+    ]
+
+def _fetch_papers(query: str, condition: str):
+    """
+    Queries Semantic Scholar with retries. Returns the list of papers found,
+    or None if every attempt failed.
+    """
     params = {'query': query, 'limit': 5, 'fields': 'title,abstract'}
-    found_files = []
 
     for attempt in range(4):  # Retry up to 4 times
         try:
-            response = requests.get(search_url, params=params, timeout=15)
+            response = _SESSION.get(SEARCH_URL, params=params, timeout=15)
             
             if response.status_code == 429:
                 wait_time = 2 ** attempt
@@ -52,22 +131,7 @@ def _perform_search(query: str, condition: str) -> list:
                 continue
             
             response.raise_for_status()
-            results = response.json()
-            
-            if results and results.get("data"):
-                for paper in results["data"]:
-                    if paper and paper.get("abstract"):
-                        title = paper.get("title", "Untitled Paper")
-                        abstract = paper.get("abstract", "No abstract available.")
-                        
-                        safe_filename = re.sub(r'[^\w\s-]', '', title).strip().replace(' ', '_')[:60]
-                        filepath = os.path.join(RESEARCH_PAPER_PATH, f"{safe_filename}.txt")
-                        
-                        with open(filepath, "w", encoding="utf-8") as f:
-                            f.write(f"Title: {title}\n\nAbstract: {abstract}")
-                        found_files.append(filepath)
-            
-            return found_files # Return successfully found files
+            return _extract_papers(orjson.loads(response.content))
 
         except requests.exceptions.RequestException as e:
             print(f"[Research Fetcher] API request failed on attempt {attempt + 1} for '{condition}': {e}")
@@ -75,7 +139,56 @@ def _perform_search(query: str, condition: str) -> list:
                 time.sleep(2 ** attempt)
             else:
                 print(f"[Research Fetcher] All retries failed for '{condition}'.")
-    return [] # Return empty list if all retries fail
+    return None
+
+async def _fetch_papers_async(client: httpx.AsyncClient, query: str, condition: str):
+    """Async counterpart of `_fetch_papers` that reuses the caller's HTTP client."""
+    params = {'query': query, 'limit': 5, 'fields': 'title,abstract'}
+
+    for attempt in range(4):  # Retry up to 4 times
+        try:
+            response = await client.get(SEARCH_URL, params=params, timeout=15)
+
+            if response.status_code == 429:
+                wait_time = 2 ** attempt
+                print(f"[Research Fetcher] Rate limit hit for '{condition}'. Retrying in {wait_time}s...")
+                await asyncio.sleep(wait_time)
+                continue
+
+            response.raise_for_status()
+            return _extract_papers(orjson.loads(response.content))
+
+        except httpx.HTTPError as e:
+            print(f"[Research Fetcher] API request failed on attempt {attempt + 1} for '{condition}': {e}")
+            if attempt < 3:
+                await asyncio.sleep(2 ** attempt)
+            else:
+                print(f"[Research Fetcher] All retries failed for '{condition}'.")
+    return None
+
+def _perform_search(query: str, condition: str, request_token: str = "") -> list:
+    """Helper function to perform a single (cached) search and save the papers found."""
+    papers = SEARCH_CACHE.get(query)
+    if papers is None:
+        papers = _fetch_papers(query, condition)
+        if papers is None:
+            return [] # Return empty list if all retries fail
+        SEARCH_CACHE.set(query, papers, expire=SEARCH_CACHE_TTL)
+    else:
+        print(f"[Research Fetcher] Cache hit for '{query}'.")
+    return _save_papers(papers, request_token)
+
+async def _perform_search_async(client: httpx.AsyncClient, query: str, condition: str, request_token: str = "") -> list:
+    """Async counterpart of `_perform_search`."""
+    papers = SEARCH_CACHE.get(query)
+    if papers is None:
+        papers = await _fetch_papers_async(client, query, condition)
+        if papers is None:
+            return [] # Return empty list if all retries fail
+        SEARCH_CACHE.set(query, papers, expire=SEARCH_CACHE_TTL)
+    else:
+        print(f"[Research Fetcher] Cache hit for '{query}'.")
+    return await _save_papers_async(papers, request_token)
 
 
 def fetch_and_save_papers(patient_info: str) -> list:
@@ -114,6 +227,40 @@ def fetch_and_save_papers(patient_info: str) -> list:
     print(f"[Research Fetcher] Saved a total of {len(created_files)} new research files.")
     return created_files
 
+async def fetch_and_save_papers_async(patient_info: str, client: httpx.AsyncClient, request_token: str = "") -> list:
+    """
+    Async variant of `fetch_and_save_papers` for use inside request handlers.
+    Conditions are searched concurrently, capped by a worker-wide semaphore so
+    bursts stay within Semantic Scholar's rate limits. Pass a per-request `request_token` so
+    the files written belong to that request alone.
+    """
+    conditions = extract_conditions(patient_info)
+    unique_conditions = sorted(list(set(conditions)))
+
+    os.makedirs(RESEARCH_PAPER_PATH, exist_ok=True)
+
+    async def _fetch_one(condition: str) -> list:
+        async with _SEARCH_SEMAPHORE:
+            print(f"[Research Fetcher] Searching for: 'treatment and management of {condition}'")
+            query_specific = f"treatment and management of {condition}"
+            paper_files = await _perform_search_async(client, query_specific, condition, request_token)
+
+            if not paper_files:
+                print(f"[Research Fetcher] Fallback Search for: '{condition}'")
+                paper_files = await _perform_search_async(client, condition, condition, request_token)
+
+        if paper_files:
+            print(f"[Research Fetcher] Found {len(paper_files)} paper(s) for '{condition}'.")
+        else:
+            print(f"[Research Fetcher] No papers with abstracts found for '{condition}' after all attempts.")
+        return paper_files
+
+    results = await asyncio.gather(*[_fetch_one(cond) for cond in unique_conditions])
+    created_files = [path for paper_files in results for path in paper_files]
+
+    print(f"[Research Fetcher] Saved a total of {len(created_files)} new research files.")
+    return created_files
+
 def cleanup_papers(file_paths: list):
     """
     Removes the temporary research paper files created during a request.
@@ -1,38 +1,155 @@
+import json
+import re
+from string import Formatter
+
+# Every template below is split into a static prefix and a dynamic suffix. All instruction
+# text lives in the prefix, ahead of the first placeholder, so it is byte-identical on every
+# call and provider-side prompt caches can reuse it. Keep the prefixes free of per-call
+# content and whitespace drift: even a one-character change breaks the cache hit.
+
+def _compile(template: str):
+    """
+    Splits a template into literal text and placeholder names once, at import time,
+    and returns a renderer that joins them, skipping `str.format`'s per-call parsing.
+    """
+    chunks = [(literal, field) for literal, field, _, _ in Formatter().parse(template)]
+
+    def render(**fields: str) -> str:
+        parts = []
+        for literal, field in chunks:
+            parts.append(literal)
+            if field is not None:
+                parts.append(fields[field])
+        return "".join(parts)
+
+    return render
+
+
+# --- Generation Limits ---
+# Output caps per template: decoding is sequential, so an unbounded answer is the
+# worst-case latency. A low temperature also makes repeat answers, and cache hits, stable.
+LLM_TEMPERATURE = 0.2
+# The plan is a single JSON array of about 50 tokens per condition, and patients carry up
+# to ~26 conditions; a cap below that would cut the array off mid-plan.
+RAG_MAX_NEW_TOKENS = 1536
+# Stops the model if it starts echoing the prompt's own sections back.
+RAG_STOP = ["\n\nCONTEXT:"]
+# The explanation is an intro plus one paragraph per condition, so its cap grows with the
+# plan: 26 conditions (the largest bundled patient) get about 4.2k tokens.
+PATIENT_BASE_NEW_TOKENS = 256
+PATIENT_NEW_TOKENS_PER_CONDITION = 150
+
+def patient_max_new_tokens(condition_count: int) -> int:
+    """Output cap for a patient explanation covering `condition_count` conditions."""
+    return PATIENT_BASE_NEW_TOKENS + PATIENT_NEW_TOKENS_PER_CONDITION * max(condition_count, 1)
+
+
+# --- Disclaimers ---
+# Appended by the callers after generation instead of being written by the model,
+# which saves output tokens on every call and keeps the wording fixed.
+CLINICAL_DISCLAIMER = (
+    "This preliminary plan is a summary based on limited patient data and the retrieved research abstracts. "
+    "It is not a substitute for professional medical judgement."
+)
+PATIENT_DISCLAIMER = (
+    "**Please remember:** this explanation is based on limited information and is not a substitute for "
+    "advice from your doctor. Talk to your care team before making any changes to your treatment."
+)
+
+
 # --- RAG Prompt for Clinical Assistant ---
-# This prompt guides the RAG model to generate the initial treatment plan for a medical professional.
-RAG_PROMPT_TEMPLATE = """
-You are a clinical assistant summarizing information for a medical professional.
-Based ONLY on the provided patient information and research abstracts (the CONTEXT), generate a preliminary treatment plan.
+# Shape of the treatment plan the RAG model must return. It is what the web UI renders
+# and what the patient-education step consumes, so no prose parsing is needed in between.
+RAG_PLAN_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "condition": {"type": "string"},
+            "details": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["condition", "details"],
+    },
+}
+# Braces are doubled so the schema survives template parsing as literal text.
+_RAG_PLAN_SCHEMA_TEXT = json.dumps(RAG_PLAN_SCHEMA, separators=(",", ":")).replace("{", "{{").replace("}", "}}")
 
-Organize the plan by condition. For each condition, suggest a treatment and briefly cite the supporting research from the context.
+# This prompt guides the RAG model to generate the initial treatment plan for a medical professional.
+RAG_SYSTEM_PREFIX = """Clinical assistant writing for a physician.
+Task: preliminary treatment plan from the CONTEXT only (patient info + research abstracts).
+One item per condition; details: suggested treatment, then brief citation of supporting research.
+Return only JSON matching this schema, no prose:
+""" + _RAG_PLAN_SCHEMA_TEXT + "\n\n"
 
-CONTEXT:
+# The dynamic part is two regions, ordered by how often they repeat: the retrieved
+# context (shared by every query over the same abstracts) and then the per-call
+# question. Prefix-caching servers can then reuse prefill up to the end of the context.
+RAG_CONTEXT_BLOCK = """CONTEXT:
 {context}
 
-QUESTION:
-{query}
+"""
 
-Finally, conclude with a clear disclaimer that this is a summary based on limited data and not a substitute for professional medical advice.
+RAG_QUESTION_SUFFIX = """QUESTION:
+{query}
 """
 
+RAG_DYNAMIC_SUFFIX = RAG_CONTEXT_BLOCK + RAG_QUESTION_SUFFIX
+RAG_PROMPT_TEMPLATE = RAG_SYSTEM_PREFIX + RAG_DYNAMIC_SUFFIX
+_render_rag = _compile(RAG_PROMPT_TEMPLATE)
+
+def render_rag(context: str, query: str) -> str:
+    """
+    Renders `RAG_PROMPT_TEMPLATE`; usable directly as a pathway prompt template.
+    Keep it deterministic (no timestamps, ids or per-row formatting): the batched
+    LLM in the pipeline deduplicates identical prompts by their exact bytes.
+    """
+    return _render_rag(context=context, query=query)
+
+_WS_RE = re.compile(r"\s+")
+
+def canonical_context(docs: list) -> str:
+    """
+    Builds the `{context}` block from the retrieved chunks in a fixed byte layout:
+    whitespace collapsed, duplicates dropped, ordered by source path and text rather
+    than by retrieval score. Each block keeps its source path so the model can cite
+    the paper a chunk came from. Re-retrieving the same chunks in a different order
+    then renders the same prompt, which keeps prefix and response caches hitting.
+    """
+    chunks = {}
+    for doc in docs:
+        # Pathway hands the documents over as `pw.Json` values.
+        if hasattr(doc, "as_dict"):
+            doc = doc.as_dict()
+        text = _WS_RE.sub(" ", str(doc.get("text", ""))).strip()
+        if text:
+            path = str((doc.get("metadata") or {}).get("path", ""))
+            # Keep the first source (in sorted order) for text retrieved from several files.
+            chunks[text] = min(chunks.get(text, path), path)
+
+    blocks = []
+    for path, text in sorted((path, text) for text, path in chunks.items()):
+        blocks.append(f"Source: {path}\n{text}" if path else text)
+    return "\n\n".join(blocks)
+
+def render_rag_batch(contexts: list[str], queries: list[str]) -> list[str]:
+    """Renders one RAG prompt per (context, query) pair, ready for a single batched LLM call."""
+    return [_render_rag(context=context, query=query) for context, query in zip(contexts, queries, strict=True)]
+
 
 # --- Patient Education Prompt ---
 # This prompt is used to transform a structured treatment plan into an easy-to-understand explanation for a patient.
-PATIENT_EDUCATION_PROMPT_TEMPLATE = """
-You are a compassionate healthcare assistant explaining a preliminary treatment plan to a patient.
-Your goal is to be clear, reassuring, and easy to understand. Avoid complex medical jargon.
+PATIENT_EDUCATION_PREFIX = """Explain this preliminary treatment plan to the patient.
+Rules: simple language, no jargon; brief reassuring intro; one paragraph per condition; explain what it is, the treatment and why; warm, supportive tone.
 
-Based on the following treatment plan, please write a simple, paragraph-by-paragraph explanation for the patient.
+"""
 
-**Treatment Plan Data:**
+PATIENT_EDUCATION_SUFFIX = """**Treatment Plan Data:**
 {treatment_plan}
+"""
 
-**Instructions:**
-1.  Start with a friendly and reassuring introduction.
-2.  For each condition, explain what it is in simple terms.
-3.  Explain the suggested treatment and why it is being recommended.
-4.  Maintain a positive and supportive tone throughout.
-5.  Conclude with the provided disclaimer, rephrasing it to be patient-friendly.
+PATIENT_EDUCATION_PROMPT_TEMPLATE = PATIENT_EDUCATION_PREFIX + PATIENT_EDUCATION_SUFFIX
+_render_patient_education = _compile(PATIENT_EDUCATION_PROMPT_TEMPLATE)
 
-Generate the explanation now.
-"""
+def render_patient_education(treatment_plan: str) -> str:
+    """Renders `PATIENT_EDUCATION_PROMPT_TEMPLATE`."""
+    return _render_patient_education(treatment_plan=treatment_plan)
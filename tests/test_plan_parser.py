@@ -0,0 +1,35 @@
+from src.data_processing.plan_parser import leading_plan_items, parse_treatment_plan
+
+PLAN = [
+    {"condition": "Hypertension", "details": ["ACE inhibitor [1]", "Lifestyle changes"]},
+    {"condition": "Type 2 diabetes", "details": ["Metformin"]},
+]
+PLAN_JSON = '[{"condition": "Hypertension", "details": ["ACE inhibitor [1]", "Lifestyle changes"]}, {"condition": "Type 2 diabetes", "details": ["Metformin"]}]'
+
+
+def test_fenced_json_array():
+    text = f"Here is the plan:\n```json\n{PLAN_JSON}\n```"
+    assert parse_treatment_plan(text) == (PLAN, False)
+
+
+def test_array_cut_off_mid_item_keeps_complete_items():
+    text = PLAN_JSON[:PLAN_JSON.index('"Metformin"')]
+    assert leading_plan_items(text) == PLAN[:1]
+    assert parse_treatment_plan(text) == (PLAN[:1], True)
+
+
+def test_python_literal_list():
+    assert parse_treatment_plan(repr(PLAN)) == (PLAN, False)
+
+
+def test_markdown_fallback():
+    text = "**Preliminary Treatment Plan**\n**Hypertension:** * ACE inhibitor [1] * Lifestyle changes\n**Type 2 diabetes** * Metformin"
+    assert parse_treatment_plan(text) == (PLAN, False)
+
+
+def test_leading_plan_items_ignores_non_json_brackets():
+    assert leading_plan_items("**Hypertension** * ACE inhibitor [1]") == []
+
+
+def test_failure_messages_yield_no_plan():
+    assert parse_treatment_plan("No plan was generated.") == ([], False)
@@ -0,0 +1,39 @@
+import random
+
+from src.prompt_template.prompt_template import canonical_context, patient_max_new_tokens, render_rag
+
+
+def _retrieved_docs():
+    return [
+        {"text": "Title: Metformin in type 2 diabetes\n\nAbstract: First-line therapy.", "metadata": {"path": "/research/metformin.txt"}},
+        {"text": "reduces   HbA1c\nby about 1%.", "metadata": {"path": "/research/metformin.txt"}},
+        {"text": "Title: ACE inhibitors for hypertension", "metadata": {"path": "/research/ace.txt"}},
+        {"text": "Conditions: Hypertension (disorder)", "metadata": {"path": "/patient_text/123.txt"}},
+        # Same chunk retrieved again with different whitespace, from a second file.
+        {"text": "reduces HbA1c by about 1%.  ", "metadata": {"path": "/research/metformin_copy.txt"}},
+    ]
+
+
+def test_permuted_retrieval_orders_render_identical_prompts():
+    query = "Hypertension Diabetes"
+    expected = render_rag(canonical_context(_retrieved_docs()), query)
+
+    rng = random.Random(0)
+    for _ in range(20):
+        docs = _retrieved_docs()
+        rng.shuffle(docs)
+        assert render_rag(canonical_context(docs), query) == expected
+
+
+def test_context_keeps_sources_and_drops_duplicates():
+    context = canonical_context(_retrieved_docs())
+
+    assert context.count("reduces HbA1c by about 1%.") == 1
+    assert "Source: /research/metformin.txt\nreduces HbA1c by about 1%." in context
+    assert context.index("Source: /patient_text/123.txt") < context.index("Source: /research/ace.txt")
+
+
+def test_patient_token_cap_grows_with_condition_count():
+    assert patient_max_new_tokens(26) > patient_max_new_tokens(8) > patient_max_new_tokens(1)
+    # The largest bundled patient still gets well over 100 tokens per paragraph.
+    assert patient_max_new_tokens(26) / 26 > 100